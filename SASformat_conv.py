@@ -1,17 +1,200 @@
 import streamlit as st
+import atexit
 import os
-import subprocess
-import zipfile
+import shutil
 from pathlib import Path
-from io import BytesIO
-import pandas as pd
+from functools import partial
+from itertools import zip_longest
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import get_context
+import numpy as np
+import pyarrow as pa
 import tempfile
+import time
+import uuid
+from collections import deque
 
-st.set_page_config(page_title="XPT to SAS7BDAT Converter", layout="centered")
-st.title("📦 SAS XPT to SAS7BDAT Converter")
+from converter import (
+    OUTPUT_FORMATS,
+    balanced_shards,
+    build_r_script,
+    convert_native,
+    copy_files,
+    copy_hashed,
+    duplicate_stems,
+    ensure_haven,
+    is_up_to_date,
+    is_xpt,
+    list_xpt_files,
+    prefetch,
+    preview_xpt,
+    read_output,
+    read_r_log,
+    start_r_script,
+    zip_files,
+)
 
-st.write("""
-This app converts `.xpt` files to `.sas7bdat` using R and the **haven** package.
+
+OUTPUT_MIME_TYPES = dict(OUTPUT_FORMATS.values())
+RAM_STAGING_MAX = 64 * 1024 * 1024
+RAM_STAGING_IDLE_SECS = 30 * 60
+PROCESS_POOL_MIN_BYTES = 50 * 1024 * 1024
+
+
+@st.cache_resource
+def scratch_root():
+    # One scratch directory per server process, removed when it exits.
+    root = Path(tempfile.mkdtemp(prefix="sasconv_"))
+    atexit.register(shutil.rmtree, root, ignore_errors=True)
+    return root
+
+
+@st.cache_data(show_spinner=False)
+def cached_xpt_listing(folder, mtime_ns):
+    # mtime_ns only feeds the cache key: adding, removing or renaming a file in
+    # the folder bumps it, so reruns reuse the listing until the folder changes.
+    return list_xpt_files(folder)
+
+
+@st.cache_resource
+def ram_scratch_root():
+    # Same as scratch_root(), but on tmpfs when the host has one (Linux /dev/shm).
+    if not os.path.isdir("/dev/shm"):
+        return None
+    root = Path(tempfile.mkdtemp(prefix="sasconv_", dir="/dev/shm"))
+    atexit.register(shutil.rmtree, root, ignore_errors=True)
+    return root
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def cached_preview(xpt_path, mtime_ns):
+    # Keyed on mtime_ns so an overwritten file is read again.
+    return preview_xpt(xpt_path)
+
+
+@st.cache_resource(show_spinner="Checking the R haven package...")
+def haven_setup_error():
+    # Runs the haven check once per server process rather than at the top of every
+    # shard script, which also stops parallel shards racing to install it.
+    return ensure_haven()
+
+
+def run_native_jobs(jobs, sizes, log_area, progress_bar):
+    # jobs are convert_native argument tuples; returns the set of outputs that
+    # were written and the error messages.
+    # pyreadstat holds the GIL while it builds Python objects for each value,
+    # so files are spread over worker processes rather than threads. Spawning
+    # a worker and importing pyreadstat there takes longer than converting a
+    # few small files, so small batches stay on threads.
+    n_workers = min(len(jobs), os.cpu_count() or 1)
+    if sum(sizes[job[0]] for job in jobs) > PROCESS_POOL_MIN_BYTES:
+        pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context("spawn"))
+    else:
+        pool = ThreadPoolExecutor(max_workers=n_workers)
+
+    log_lines = deque(maxlen=50)
+    converted = set()
+    errors = []
+    last_flush = 0.0
+    try:
+        futures = {pool.submit(convert_native, *job): job[1] for job in jobs}
+
+        # wait() with a timeout rather than as_completed(), so the staged inputs are
+        # marked as in use even while one long file keeps every worker busy.
+        not_done = set(futures)
+        while not_done:
+            finished, not_done = wait(not_done, timeout=1, return_when=FIRST_COMPLETED)
+            mark_ram_staging_in_use()
+            for future in finished:
+                stdout, stderr = future.result()
+                log_lines.extend(stdout.splitlines())
+                if stderr is None:
+                    converted.add(futures[future])
+                else:
+                    errors.append(stderr)
+            # Each UI update is a round trip to the browser; cap them at 4/s.
+            if finished and time.monotonic() - last_flush > 0.25:
+                log_area.code("\n".join(log_lines))
+                progress_bar.progress(1 - len(not_done) / len(futures))
+                last_flush = time.monotonic()
+    except BaseException:
+        # Streamlit stops the script at its next st.* call when a widget changes or
+        # the session closes. Waiting for the pool, as `with pool` would, hangs the
+        # page until the whole batch is done, so drop the queued jobs and stop the
+        # worker processes still converting. Threads can't be stopped; they finish
+        # their current file in the background.
+        workers = list((getattr(pool, "_processes", None) or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for worker in workers:
+            worker.terminate()
+        raise
+    pool.shutdown()
+
+    log_area.code("\n".join(log_lines))
+    return converted, errors
+
+
+def mark_ram_staging_in_use():
+    # Refreshes the mtime that sweep_ram_staging() reads as this session's last
+    # use. Called on every rerun and from the conversion poll loops, as a long
+    # run doesn't rerun the script and would otherwise look idle.
+    root = ram_scratch_root()
+    if root is None:
+        return
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    try:
+        os.utime(root / st.session_state.session_id)
+    except FileNotFoundError:
+        pass
+
+
+def sweep_ram_staging():
+    # Streamlit has no session-end hook, so tmpfs staging, which counts against the
+    # container's memory, is reclaimed by age: directories of sessions idle for
+    # longer than RAM_STAGING_IDLE_SECS are removed. A swept session that comes
+    # back re-stages its uploads, as the staging loop copies any file whose
+    # staged copy is gone.
+    root = ram_scratch_root()
+    if root is None:
+        return
+    mark_ram_staging_in_use()
+    cutoff = time.time() - RAM_STAGING_IDLE_SECS
+    with os.scandir(root) as entries:
+        for e in entries:
+            if e.name == st.session_state.session_id:
+                continue
+            try:
+                idle = e.stat().st_mtime < cutoff
+            except FileNotFoundError:
+                # Another session's sweep removed it first.
+                continue
+            if idle:
+                shutil.rmtree(e.path, ignore_errors=True)
+
+
+def session_dir(name, nbytes=None):
+    # Passing nbytes lets a small file be staged in RAM: tmpfs pages count against
+    # the container's memory, so only files up to RAM_STAGING_MAX bytes go there,
+    # and only while tmpfs has at least three times that much room left.
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    root = scratch_root()
+    if nbytes is not None and nbytes <= RAM_STAGING_MAX and ram_scratch_root() is not None:
+        if shutil.disk_usage(ram_scratch_root()).free > 3 * nbytes:
+            root = ram_scratch_root()
+    path = root / st.session_state.session_id / name
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def main():
+    st.set_page_config(page_title="XPT to SAS7BDAT Converter", layout="centered")
+    st.title("📦 SAS XPT to SAS7BDAT Converter")
+
+    st.write("""
+This app converts `.xpt` files to `.sas7bdat` using R and the **haven** package,
+or to Parquet / Feather in-process with **pyreadstat**.
 
 ### You can:
 - 📂 Specify a folder containing `.xpt` files
@@ -20,126 +203,336 @@ This app converts `.xpt` files to `.sas7bdat` using R and the **haven** package.
 - 💾 Optionally save output to disk
 """)
 
-conversion_method = st.radio("Choose Input Method:", ["Upload Files","Folder Path"])
-save_output = st.checkbox("Save converted files to server (in session folder)")
-xpt_files = []
-source_label = ""
-input_dir = None
+    conversion_method = st.radio("Choose Input Method:", ["Upload Files","Folder Path"])
+    output_format = st.radio("Output format:", list(OUTPUT_FORMATS), horizontal=True)
+    output_ext = OUTPUT_FORMATS[output_format][0]
+    save_output = st.checkbox("Save converted files to server (in session folder)")
+    force_reconvert = st.checkbox("Force reconvert files whose output is already up to date")
+    also_parquet = output_format == "SAS7BDAT" and st.checkbox(
+        "Also write Parquet (zstd) next to each .sas7bdat, for reading back from Python"
+    )
+    # SAS7BDAT always stores doubles, so this only applies to Parquet/Feather output.
+    downcast = (output_format != "SAS7BDAT" or also_parquet) and st.checkbox(
+        "Store float columns as float32 where no value changes"
+    )
+    xpt_files = []
+    xpt_sizes = []
+    source_label = ""
+    input_dir = None
+
+    if conversion_method == "Folder Path":
+        folder_path = st.text_input("Enter full path to folder containing .xpt files")
+        show_path = st.button("Show Folder Path")
+
+        if folder_path:
+            # resolve() walks every path component on disk; only redo it when the text changes.
+            if st.session_state.get("folder_raw") != folder_path:
+                st.session_state.folder_raw = folder_path
+                st.session_state.input_dir = Path(folder_path).expanduser().resolve()
+            input_dir = st.session_state.input_dir
+
+            if show_path:
+                st.info(f"📁 Full folder path: `{input_dir}`")
+
+            if input_dir.exists() and input_dir.is_dir():
+                listing = cached_xpt_listing(str(input_dir), input_dir.stat().st_mtime_ns)
+                xpt_files = [path for path, _ in listing]
+                xpt_sizes = [size for _, size in listing]
+                source_label = f"from folder: `{input_dir}`"
+            else:
+                st.error("Invalid folder path.")
+
+    elif conversion_method == "Upload Files":
+        uploaded = st.file_uploader("Upload one or more `.xpt` files", type=["xpt"], accept_multiple_files=True)
+        sweep_ram_staging()
+        staged = st.session_state.setdefault("staged_uploads", {})
+        # Files removed from the uploader give back their staged copies straight away.
+        for name in staged.keys() - {file.name for file in uploaded}:
+            staged.pop(name)[1].unlink(missing_ok=True)
+        if uploaded:
+            # Every widget interaction reruns this script with the same uploads, so
+            # stage them once per session and only copy files that are new.
+            for file in uploaded:
+                previous = staged.get(file.name)
+                if previous is None or previous[0] != file.file_id or not previous[1].exists():
+                    file_path = session_dir("uploads", file.size) / file.name
+                    part_path = file_path.with_name(file_path.name + ".part")
+                    digest = copy_hashed(file, part_path)
+                    # Uploading the same bytes again keeps the staged copy and its mtime,
+                    # so outputs converted from it stay up to date and are not redone.
+                    if previous is not None and previous[2] == digest and previous[1].exists():
+                        part_path.unlink()
+                        file_path = previous[1]
+                    else:
+                        if previous is not None:
+                            previous[1].unlink(missing_ok=True)
+                        part_path.replace(file_path)
+                    staged[file.name] = (file.file_id, file_path, digest)
+            # Sorted by name: staged copies can sit under either scratch root.
+            listing = sorted(((staged[file.name][1], file.size) for file in uploaded), key=lambda item: item[0].name)
+            xpt_files = [path for path, _ in listing]
+            xpt_sizes = [size for _, size in listing]
+            source_label = "from uploaded files"
 
-if conversion_method == "Folder Path":
-    folder_path = st.text_input("Enter full path to folder containing .xpt files")
-    show_path = st.button("Show Folder Path")
+    # Files that would write the same output are reported and left out, rather
+    # than converted side by side into one path.
+    clashing = duplicate_stems(xpt_files)
+    if clashing:
+        st.error(
+            "❌ These files would write the same output file and are skipped; rename them to convert: "
+            + ", ".join(f"`{f.name}`" for f in clashing)
+        )
+        listing = [(f, size) for f, size in zip(xpt_files, xpt_sizes) if f not in clashing]
+        xpt_files = [path for path, _ in listing]
+        xpt_sizes = [size for _, size in listing]
 
-    if folder_path:
-        input_dir = Path(folder_path).expanduser().resolve()
+    # File selection
+    selected_files = []
 
-        if show_path:
-            st.info(f"📁 Full folder path: `{input_dir}`")
+    if xpt_files:
+        st.success(f"✅ Found {len(xpt_files)} .xpt file(s) {source_label}")
 
-        if input_dir.exists() and input_dir.is_dir():
-            xpt_files = sorted(list(input_dir.glob("*.xpt")))
-            source_label = f"from folder: `{input_dir}`"
+        # A pyarrow Table goes straight to Arrow IPC; a dict would be routed through pandas.
+        st.dataframe(pa.table({
+            "File Name": [f.name for f in xpt_files],
+            "Size (KB)": (np.asarray(xpt_sizes, dtype=np.int64) / 1024).round(2)
+        }), width="stretch")
+
+        selected_file_names = st.multiselect(
+            "Select files to convert",
+            options=[f.name for f in xpt_files],
+            default=[f.name for f in xpt_files]
+        )
+        selected_files = [f for f in xpt_files if f.name in selected_file_names]
+
+        preview_name = st.selectbox(
+            "Preview a file",
+            options=[f.name for f in xpt_files],
+            index=None,
+            placeholder="Choose a file to preview its first rows and labels"
+        )
+        if preview_name:
+            preview_file = next(f for f in xpt_files if f.name == preview_name)
+            # The selectbox keeps its value across reruns, so a read error here must not
+            # stop the script or the Run button below would never render again.
+            if not is_xpt(preview_file):
+                st.error(f"❌ `{preview_name}` is not a SAS transport (XPT) file.")
+            else:
+                try:
+                    preview_df, preview_meta = cached_preview(str(preview_file), preview_file.stat().st_mtime_ns)
+                except Exception as e:
+                    st.error(f"❌ Could not preview `{preview_name}`: {e}")
+                else:
+                    if preview_meta.file_label:
+                        st.caption(preview_meta.file_label)
+                    st.dataframe(preview_df, width="stretch")
+                    st.dataframe(
+                        {"Column": preview_meta.column_names, "Label": preview_meta.column_labels},
+                        width="stretch"
+                    )
+
+    if selected_files:
+        if conversion_method == "Upload Files":
+            output_dir = session_dir("converted")
         else:
-            st.error("Invalid folder path.")
-
-elif conversion_method == "Upload Files":
-    uploaded = st.file_uploader("Upload one or more `.xpt` files", type=["xpt"], accept_multiple_files=True)
-    if uploaded:
-        input_dir = Path(tempfile.mkdtemp())
-        for file in uploaded:
-            file_path = input_dir / file.name
-            file_path.write_bytes(file.read())
-        xpt_files = sorted(input_dir.glob("*.xpt"))
-        source_label = "from uploaded files"
-
-# File selection
-selected_files = []
-
-if xpt_files:
-    st.success(f"✅ Found {len(xpt_files)} .xpt file(s) {source_label}")
-
-    file_df = pd.DataFrame({
-        "File Name": [f.name for f in xpt_files],
-        "Size (KB)": [round(f.stat().st_size / 1024, 2) for f in xpt_files]
-    })
-    st.dataframe(file_df, use_container_width=True)
-
-    selected_file_names = st.multiselect(
-        "Select files to convert",
-        options=[f.name for f in xpt_files],
-        default=[f.name for f in xpt_files]
-    )
-    selected_files = [f for f in xpt_files if f.name in selected_file_names]
-
-if selected_files:
-    output_dir = Path(tempfile.mkdtemp()) if conversion_method == "Upload Files" else input_dir / "converted_sas7bdat"
-    output_dir.mkdir(exist_ok=True)
-
-    # R script generation
-    r_script_lines = [
-        'if (!requireNamespace("haven", quietly = TRUE)) {',
-        '  install.packages("haven", repos = "https://cloud.r-project.org")',
-        '}',
-        'library(haven)'
-    ]
-
-    for xpt_file in selected_files:
-        out_file = output_dir / (xpt_file.stem + ".sas7bdat")
-        r_script_lines.append(f'data <- read_xpt("{xpt_file.as_posix()}")')
-        r_script_lines.append(f'write_sas(data, "{out_file.as_posix()}")\n')
-
-    r_script = "\n".join(r_script_lines)
-    st.subheader("Generated R Script")
-    st.code(r_script, language="r")
-
-    if st.button("🚀 Run Conversion"):
-        r_script_path = output_dir / "convert_selected.R"
-        r_script_path.write_text(r_script)
-
-        try:
-            result = subprocess.run(
-                ["Rscript", str(r_script_path)],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                check=True
+            output_dir = input_dir / f"converted_{output_ext[1:]}"
+        output_dir.mkdir(exist_ok=True)
+
+        # Make-style incremental build: skip files whose output is newer than the .xpt.
+        pending_files = [
+            f for f in selected_files
+            if force_reconvert or not is_up_to_date(f, output_dir / (f.stem + output_ext))
+        ]
+        skipped = len(selected_files) - len(pending_files)
+        if skipped:
+            st.info(f"⏭️ {skipped}/{len(selected_files)} file(s) already up to date, skipping.")
+
+        if output_format == "SAS7BDAT" and pending_files:
+            r_script = build_r_script(pending_files, output_dir)
+            st.subheader("Generated R Script")
+            st.code(r_script, language="r")
+
+        if st.button("🚀 Run Conversion"):
+            # Reject files that aren't SAS transport files up front, so they are reported
+            # without starting R or pyreadstat; they are listed apart from the
+            # conversion errors and marked in the results table.
+            invalid_files = [f for f in pending_files if not is_xpt(f)]
+            errors = []
+            pending_files = [f for f in pending_files if f not in invalid_files]
+            n_workers = min(len(pending_files), os.cpu_count() or 1)
+            # Progress and log live in one status box that collapses to a one-line
+            # summary when the run ends, instead of a stack of separate messages.
+            status = st.status(f"Converting {len(pending_files)} file(s)...", expanded=True)
+            progress_bar = status.progress(0.0)
+            log_area = status.empty()
+            native_jobs = []
+            converted = set()
+            sizes = dict(zip(xpt_files, xpt_sizes))
+
+            if output_format == "SAS7BDAT":
+                # Each Rscript run converts its files one after another, so split the
+                # selection into one shard per core and run the shards side by side.
+                setup_error = haven_setup_error() if pending_files else None
+                if setup_error is not None:
+                    # Don't keep a failed setup cached; the next run tries again.
+                    haven_setup_error.clear()
+                    errors.append(setup_error)
+                shards = balanced_shards(pending_files, sizes, n_workers) if setup_error is None else []
+                # Hint the inputs in the order the shards will open them: every shard's
+                # first (largest) file, then every shard's second, and so on.
+                prefetch([f for files in zip_longest(*shards) for f in files if f is not None], sizes)
+                runs = []
+                try:
+                    for i, shard in enumerate(shards):
+                        r_script_path = output_dir / f"convert_selected_{i}.R"
+                        r_script_path.write_text(build_r_script(shard, output_dir))
+                        runs.append((r_script_path, start_r_script(r_script_path)))
+
+                    # The shards run in the background; poll their logs so the page shows
+                    # per-file progress instead of blocking until every Rscript exits.
+                    while True:
+                        finished = all(proc.poll() is not None for _, proc in runs)
+                        log_lines = [line for path, _ in runs for line in read_r_log(path).splitlines()]
+                        done = sum(line.startswith(("Converted ", "Failed ")) for line in log_lines)
+                        log_area.code("\n".join(log_lines[-50:]))
+                        progress_bar.progress(done / max(len(pending_files), 1))
+                        mark_ram_staging_in_use()
+                        if finished:
+                            break
+                        time.sleep(0.25)
+                finally:
+                    # Streamlit stops the script at its next st.* call when a widget changes
+                    # or the session closes. Don't leave shards running behind it, where a
+                    # later run would start a second set writing the same outputs.
+                    for _, proc in runs:
+                        if proc.poll() is None:
+                            proc.terminate()
+                            proc.wait()
+
+                # Each shard prints "Converted <name>" once a file is written; those lines,
+                # not output mtimes, say which files this run actually converted.
+                converted = {
+                    output_dir / (Path(line.split(" ", 1)[1].strip()).stem + ".sas7bdat")
+                    for line in log_lines if line.startswith("Converted ")
+                }
+                errors += [line for line in log_lines if line.startswith("Failed ")]
+                errors += [read_r_log(path, ".err") for path, proc in runs if proc.returncode]
+                if also_parquet:
+                    native_jobs = [
+                        (f, output_dir / (f.stem + ".parquet"), "Parquet", "zstd", downcast)
+                        for f in selected_files
+                        if f not in invalid_files
+                        and (force_reconvert or not is_up_to_date(f, output_dir / (f.stem + ".parquet")))
+                    ]
+                    if native_jobs:
+                        # The copies get a bar of their own, so progress doesn't drop back
+                        # from the 100% the R shards just reached.
+                        progress_bar.progress(1.0)
+                        status.update(label=f"Writing {len(native_jobs)} Parquet copy(ies)...")
+                        progress_bar = status.progress(0.0)
+            else:
+                native_jobs = [
+                    (f, output_dir / (f.stem + output_ext), output_format, None, downcast)
+                    for f in pending_files
+                ]
+                # Jobs start in submission order. The Parquet copies made after the R
+                # shards aren't hinted: R has just read those files into the cache.
+                prefetch([job[0] for job in native_jobs], sizes)
+
+            if native_jobs:
+                native_converted, native_errors = run_native_jobs(native_jobs, sizes, log_area, progress_bar)
+                converted |= native_converted
+                errors += native_errors
+
+            progress_bar.progress(1.0)
+
+            # One results table for the batch instead of a status message per file.
+            # With "Also write Parquet" the copies get their own column, so a failed
+            # copy isn't hidden behind a converted .sas7bdat.
+            outputs = {"Status": (output_ext, set(pending_files))}
+            if also_parquet:
+                outputs["Parquet copy"] = (".parquet", {job[0] for job in native_jobs})
+            statuses = {
+                column: [
+                    "❌ Not an XPT file" if f in invalid_files
+                    else "⏭️ Up to date" if f not in attempted
+                    else "✅ Converted" if output_dir / (f.stem + ext) in converted
+                    else "❌ Failed"
+                    for f in selected_files
+                ]
+                for column, (ext, attempted) in outputs.items()
+            }
+            status.update(
+                label="❌ Conversion finished with errors" if errors or invalid_files else "🎉 Conversion completed successfully!",
+                state="error" if errors or invalid_files else "complete",
+                expanded=False
             )
-            st.success("🎉 Conversion completed successfully!")
-            st.text(result.stdout)
 
-            converted_files = [output_dir / (f.stem + ".sas7bdat") for f in selected_files]
+            converted_files = [output_dir / (f.stem + output_ext) for f in selected_files]
+            if also_parquet:
+                converted_files += [output_dir / (f.stem + ".parquet") for f in selected_files]
+            converted_files = [f for f in converted_files if f.exists()]
+
+            # Kept in session state so the results and download buttons survive the
+            # reruns triggered by later widget changes instead of vanishing with the
+            # button press that produced them.
+            st.session_state.last_result = {
+                "key": (output_dir, output_ext, also_parquet, tuple(selected_files)),
+                "errors": errors,
+                "invalid": [f.name for f in invalid_files],
+                "r_errors": output_format == "SAS7BDAT" and not native_jobs,
+                "files": [f.name for f in selected_files],
+                "statuses": statuses,
+                "converted_files": converted_files
+            }
+
+            if save_output and converted_files:
+                saved_dir = Path.cwd() / "saved_converted_output"
+                saved_dir.mkdir(exist_ok=True)
+                copy_files(converted_files, saved_dir)
+                st.success(f"✔️ Files also saved to: `{saved_dir}`")
 
+        result = st.session_state.get("last_result")
+        if result and result["key"] == (output_dir, output_ext, also_parquet, tuple(selected_files)):
+            # Success is already shown by the results table; only errors need detail.
+            if result["invalid"]:
+                st.error("❌ Not SAS transport (XPT) files, skipped: " + ", ".join(f"`{name}`" for name in result["invalid"]))
+            if result["errors"]:
+                st.error("❌ Error running R script:" if result["r_errors"] else "❌ Error converting files:")
+                for stderr in result["errors"]:
+                    st.code(stderr)
+
+            st.dataframe(pa.table({
+                "File Name": result["files"],
+                **result["statuses"]
+            }), width="stretch")
+
+            converted_files = [f for f in result["converted_files"] if f.exists()]
             if converted_files:
                 st.subheader("📥 Download Converted Files")
 
+                # Passing a callable defers the read until that button is clicked, and
+                # on_click="ignore" keeps the click from rerunning the conversion page.
                 for file in converted_files:
-                    with open(file, "rb") as f:
-                        st.download_button(
-                            label=f"Download {file.name}",
-                            data=f.read(),
-                            file_name=file.name,
-                            mime="application/octet-stream"
-                        )
-
-                # ZIP download
-                zip_buf = BytesIO()
-                with zipfile.ZipFile(zip_buf, "w") as zf:
-                    for f in converted_files:
-                        zf.write(f, arcname=f.name)
+                    st.download_button(
+                        label=f"Download {file.name}",
+                        data=partial(read_output, file),
+                        file_name=file.name,
+                        mime=OUTPUT_MIME_TYPES[file.suffix],
+                        on_click="ignore"
+                    )
+
+                # ZIP download: the archive is only built when the button is clicked
                 st.download_button(
                     "Download All as ZIP",
-                    data=zip_buf.getvalue(),
-                    file_name="converted_sas7bdat.zip",
-                    mime="application/zip"
+                    data=partial(zip_files, converted_files),
+                    file_name=f"converted_{output_ext[1:]}.zip",
+                    mime="application/zip",
+                    on_click="ignore"
                 )
 
-                if save_output:
-                    saved_dir = Path.cwd() / "saved_converted_output"
-                    saved_dir.mkdir(exist_ok=True)
-                    for f in converted_files:
-                        (saved_dir / f.name).write_bytes(f.read_bytes())
-                    st.success(f"✔️ Files also saved to: `{saved_dir}`")
 
-        except subprocess.CalledProcessError as e:
-            st.error("❌ Error running R script:")
-            st.code(e.stderr)
+# Streamlit runs this script as __main__. Spawned pool workers import it as
+# __mp_main__ instead, so they skip the UI and only load the helpers above.
+if __name__ == "__main__":
+    main()
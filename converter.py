@@ -0,0 +1,302 @@
+# Conversion helpers for SASformat_conv.py. Kept free of Streamlit calls so the
+# script stays UI-only and these functions can be imported by worker processes.
+
+import hashlib
+import heapq
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyreadstat
+
+
+# Output format -> (file extension, download MIME type)
+OUTPUT_FORMATS = {
+    "SAS7BDAT": (".sas7bdat", "application/octet-stream"),
+    "Parquet": (".parquet", "application/vnd.apache.parquet"),
+    "Feather": (".feather", "application/vnd.apache.arrow.file"),
+}
+
+# install.packages() only warns when it fails, so the second check is what makes
+# Rscript exit non-zero and lets ensure_haven() report the failure.
+HAVEN_SETUP = (
+    'if (!requireNamespace("haven", quietly = TRUE)) '
+    'install.packages("haven", repos = "https://cloud.r-project.org"); '
+    'if (!requireNamespace("haven", quietly = TRUE)) '
+    'stop("the haven package is not installed and could not be installed")'
+)
+
+# XPTs above CHUNKED_MIN_BYTES are converted CHUNK_ROWS rows at a time.
+CHUNKED_MIN_BYTES = 256 * 1024 * 1024
+CHUNK_ROWS = 200_000
+PREFETCH_MAX_BYTES = 1024 * 1024 * 1024
+
+# SAS formats pyreadstat reads as times of day rather than dates or datetimes.
+SAS_TIME_FORMATS = ("TIME", "HHMM", "TOD", "IS8601TM", "E8601TM", "B8601TM")
+
+
+def ensure_haven():
+    # Installs haven into the R library if it is missing. Returns the error text
+    # when that fails, else None.
+    try:
+        proc = subprocess.run(["Rscript", "-e", HAVEN_SETUP], capture_output=True, text=True)
+    except FileNotFoundError:
+        return "Rscript was not found on PATH."
+    return proc.stderr if proc.returncode else None
+
+
+def r_string(path):
+    # R string literals share JSON's escapes (\", \\, \n, \uXXXX), so a quote or
+    # backslash in a file name can't end the literal and inject R code.
+    return json.dumps(path.as_posix(), ensure_ascii=False)
+
+
+def build_r_script(xpt_files, output_dir):
+    # One vector of inputs and outputs driven by a single mapply keeps the
+    # script body the same size however many files are selected.
+    xpt_paths = ", ".join(r_string(f) for f in xpt_files)
+    out_paths = ", ".join(r_string(output_dir / (f.stem + ".sas7bdat")) for f in xpt_files)
+    # Each file is converted under its own tryCatch, so one bad file is reported
+    # as "Failed <name>: <error>" and the rest of the shard still runs. haven
+    # writes to a .part sibling that is only renamed into place on success.
+    r_script_lines = [
+        'library(haven)',
+        '',
+        f'xpt_paths <- c({xpt_paths})',
+        f'out_paths <- c({out_paths})',
+        '',
+        'invisible(mapply(function(xpt_path, out_path) {',
+        '  part_path <- paste0(out_path, ".part")',
+        '  tryCatch({',
+        '    write_sas(read_xpt(xpt_path), part_path)',
+        '    if (!file.rename(part_path, out_path)) stop("could not replace ", out_path)',
+        '    cat("Converted", basename(xpt_path), "\\n")',
+        '  }, error = function(e) {',
+        '    unlink(part_path)',
+        '    cat("Failed ", basename(xpt_path), ": ", gsub("\\n", " ", conditionMessage(e)), "\\n", sep = "")',
+        '  })',
+        '  flush.console()',
+        '}, xpt_paths, out_paths))'
+    ]
+
+    return "\n".join(r_script_lines)
+
+
+def balanced_shards(files, sizes, n_shards):
+    # Longest-processing-time first: hand the largest remaining file to the
+    # lightest shard, so shards end up with similar byte counts and finish together.
+    shards = [[] for _ in range(n_shards)]
+    loads = [(0, i) for i in range(n_shards)]
+    for f in sorted(files, key=sizes.__getitem__, reverse=True):
+        load, i = heapq.heappop(loads)
+        shards[i].append(f)
+        heapq.heappush(loads, (load + sizes[f], i))
+    return shards
+
+
+def start_r_script(r_script_path):
+    # Output goes to .out/.err files next to the script rather than to pipes: the
+    # app polls while Rscript runs, and an undrained pipe would stall it once full.
+    with open(r_script_path.with_suffix(".out"), "w") as out, open(r_script_path.with_suffix(".err"), "w") as err:
+        return subprocess.Popen(["Rscript", str(r_script_path)], stdout=out, stderr=err)
+
+
+def read_r_log(r_script_path, suffix=".out"):
+    return r_script_path.with_suffix(suffix).read_text()
+
+
+def prefetch(files, sizes, max_bytes=PREFETCH_MAX_BYTES):
+    # Asks the kernel to start reading the inputs into the page cache, so the
+    # worker that reaches a file later finds it cached instead of waiting on disk.
+    # files should be in the order the work opens them. Hints stop adding up at
+    # max_bytes to avoid evicting the files being converted first; a file that no
+    # longer fits is skipped rather than ending the pass, as the next may still fit.
+    # No-op where posix_fadvise is unavailable (Windows, macOS).
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for f in files:
+        if sizes[f] > max_bytes:
+            continue
+        max_bytes -= sizes[f]
+        try:
+            fd = os.open(f, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def chunk_schema(table, meta):
+    # The Arrow schema every chunk is cast to, taken from the first chunk. A
+    # column with no values there comes back as type null (pyreadstat leaves an
+    # all-missing date column as object), so its type is taken from the XPT
+    # metadata instead: strings stay strings, SAS time formats become time64 and
+    # the remaining numerics, the date/datetime columns, become timestamps.
+    fields = []
+    for field in table.schema:
+        if pa.types.is_null(field.type):
+            sas_format = (meta.original_variable_types.get(field.name) or "").upper()
+            if meta.readstat_variable_types.get(field.name) == "string":
+                field = field.with_type(pa.string())
+            elif sas_format.startswith(SAS_TIME_FORMATS):
+                field = field.with_type(pa.time64("us"))
+            else:
+                field = field.with_type(pa.timestamp("us"))
+        fields.append(field)
+    return pa.schema(fields, metadata=table.schema.metadata)
+
+
+def write_chunked(xpt_file, out_file, output_format, compression=None):
+    # Streams the XPT through pyarrow writers one chunk at a time, so peak memory
+    # is one chunk rather than the whole file. Both formats need a single schema
+    # up front, so each chunk is cast to chunk_schema(); safe=False lets
+    # nanosecond timestamps (older pandas) land in a microsecond column.
+    chunks = pyreadstat.read_file_in_chunks(
+        pyreadstat.read_xport, str(xpt_file), chunksize=CHUNK_ROWS, dates_as_pandas_datetime=True
+    )
+    schema = writer = None
+    try:
+        for df, meta in chunks:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None:
+                schema = chunk_schema(table, meta)
+                if output_format == "Parquet":
+                    writer = pq.ParquetWriter(str(out_file), schema, compression=compression or "snappy")
+                else:
+                    options = pa.ipc.IpcWriteOptions(compression=compression or "zstd")
+                    writer = pa.ipc.new_file(str(out_file), schema, options=options)
+            writer.write_table(table.cast(schema, safe=False))
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def downcast_floats(df):
+    # XPT numerics always come back as float64; store a column as float32 only
+    # when every value survives the round trip (NaNs included), so nothing is lost.
+    for col in df.select_dtypes("float64").columns:
+        down = df[col].astype("float32")
+        if down.astype("float64").equals(df[col]):
+            df[col] = down
+    return df
+
+
+def convert_native(xpt_file, out_file, output_format, compression=None, downcast=False):
+    # Parquet/Feather need no R: pyreadstat reads the XPT, pyarrow writes it.
+    # downcast is skipped for chunked files: the first chunk fixes the schema,
+    # and a later chunk may hold values float32 cannot represent.
+    # The output is written to a .part sibling and only renamed into place once
+    # complete, so a failed run never leaves a truncated file that looks current.
+    part_file = out_file.with_name(out_file.name + ".part")
+    try:
+        if os.path.getsize(xpt_file) > CHUNKED_MIN_BYTES:
+            write_chunked(xpt_file, part_file, output_format, compression)
+        else:
+            df, meta = pyreadstat.read_xport(str(xpt_file), dates_as_pandas_datetime=True)
+            if downcast:
+                df = downcast_floats(df)
+            if output_format == "Parquet":
+                df.to_parquet(part_file, engine="pyarrow", compression=compression or "snappy", index=False)
+            else:
+                df.to_feather(part_file, compression=compression or "zstd")
+        os.replace(part_file, out_file)
+    except Exception as e:
+        part_file.unlink(missing_ok=True)
+        return "", f"{xpt_file.name}: {e}"
+    return f"Converted {xpt_file.name}\n", None
+
+
+def list_xpt_files(folder):
+    # Returns sorted (path, size) pairs collected in the same scandir pass.
+    with os.scandir(folder) as entries:
+        return sorted(
+            (Path(e.path), e.stat().st_size) for e in entries
+            if not e.name.startswith(".")
+            and e.name.lower().endswith(".xpt")
+            and e.is_file()
+        )
+
+
+def duplicate_stems(files):
+    # Files whose outputs would share a path: DM.xpt and DM.XPT (or dm.xpt, on a
+    # case-insensitive output folder) both write DM.<ext>, and converting both
+    # would race on the same .part and output file.
+    by_stem = {}
+    for f in files:
+        by_stem.setdefault(f.stem.casefold(), []).append(f)
+    return [f for group in by_stem.values() if len(group) > 1 for f in group]
+
+
+def preview_xpt(xpt_file, n_rows=5):
+    # row_limit stops ReadStat after n_rows, so previews cost the same for any size.
+    return pyreadstat.read_xport(str(xpt_file), row_limit=n_rows)
+
+
+def copy_hashed(src, dst_path, chunk_size=1024 * 1024):
+    # Copies a file object to dst_path and returns the BLAKE2b digest of its
+    # bytes, hashed in the same pass so the upload is only read once.
+    digest = hashlib.blake2b(digest_size=16)
+    with open(dst_path, "wb") as out:
+        while chunk := src.read(chunk_size):
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+
+def is_xpt(path):
+    # A SAS transport file opens with an 80-byte library header record: "LIBRARY"
+    # for version 5, "LIBV8" for version 8/9. Checking it costs one small read,
+    # against an R start-up or a pyreadstat parse for a file that would fail anyway.
+    try:
+        with open(path, "rb") as f:
+            header = f.read(80)
+    except OSError:
+        return False
+    return header.startswith((b"HEADER RECORD*******LIBRARY HEADER RECORD", b"HEADER RECORD*******LIBV8   HEADER RECORD"))
+
+
+def is_up_to_date(xpt_file, out_file):
+    try:
+        return out_file.stat().st_mtime >= xpt_file.stat().st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def copy_files(files, dest_dir, max_workers=8):
+    # shutil.copyfile uses sendfile() on Linux and drops the GIL while copying,
+    # so a few threads keep several copies in flight instead of one at a time.
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(lambda f: shutil.copyfile(f, dest_dir / f.name), files))
+
+
+def read_output(path):
+    # Download data for one output file, read in one go. The SEQUENTIAL hint on
+    # Linux lets the kernel read ahead more aggressively for it.
+    with open(path, "rb") as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return f.read()
+
+
+def zip_files(files):
+    # Members are STORED: sas7bdat/parquet/feather output gains little from
+    # DEFLATE and it would make bundling CPU-bound. ZIP64 covers bundles past 4 GiB.
+    # The archive is built in a spooled file that stays in memory for small
+    # bundles and rolls over to disk past 64 MiB.
+    with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as spool:
+        with zipfile.ZipFile(spool, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for f in files:
+                zf.write(f, arcname=f.name)
+        # download_button only takes bytes, BytesIO or plain opened files, and it
+        # reads those into memory anyway, so hand the finished archive over as bytes.
+        spool.seek(0)
+        return spool.read()